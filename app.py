@@ -1,6 +1,10 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
 import io
+import os
+from functools import partial
 
 # ==========================================
 # TEXT CONFIGURATION
@@ -66,117 +70,364 @@ except FileNotFoundError:
     st.warning("Note: style.css not found. UI might look unstyled.")
 
 # --- LOAD CENSUS DATA (Cached) ---
+# Census columns and the names they get in the enriched report
+CENSUS_COLUMNS = {
+    'median_income': 'Estimated household income',
+    'median_age': 'Median age',
+    'population': 'Zip population'
+}
+
+CENSUS_CSV = "census_reference.csv"
+# Typed, compressed copy of the CSV written on first load; cold starts read this instead
+CENSUS_PARQUET = "census_reference.parquet"
+# Zips are keyed as integers (00601 -> 601), see clean_zip_codes. Income and
+# population are whole numbers and exact in 32 bits; ages like 29.2 are not
+# representable in float32 and would show up as 29.2000007 in the Excel export.
+# Population is nullable so unmatched rows stay Int32 instead of becoming float64.
+CENSUS_DTYPES = {'zip_code': 'uint32', 'median_income': 'float32', 'median_age': 'float64', 'population': 'Int32'}
+
+def read_census_parquet():
+    # The cache is only trusted if it is at least as new as the CSV and reads cleanly
+    if not os.path.exists(CENSUS_PARQUET) or os.path.getmtime(CENSUS_PARQUET) < os.path.getmtime(CENSUS_CSV):
+        return None
+    try:
+        # astype keeps CENSUS_DTYPES authoritative for caches written by older versions
+        return pd.read_parquet(CENSUS_PARQUET, engine='pyarrow', memory_map=True).astype(CENSUS_DTYPES)
+    except (OSError, ValueError):
+        return None  # Truncated or corrupt cache: rebuild it from the CSV
+
+def write_census_parquet(df):
+    # Write to a temp file and swap it in, so a failed write never leaves a partial cache
+    tmp_path = f"{CENSUS_PARQUET}.{os.getpid()}.tmp"
+    try:
+        df.to_parquet(tmp_path, compression='zstd')
+        os.replace(tmp_path, CENSUS_PARQUET)
+    except OSError:
+        # Read-only or full filesystem: just use the parsed CSV
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
 @st.cache_data
 def load_census_data():
     try:
-        df = pd.read_csv("census_reference.csv")
-        df['zip_code'] = df['zip_code'].astype(str).str.zfill(5)
-        return df
+        df = read_census_parquet()
+        if df is None:
+            df = pd.read_csv(CENSUS_CSV, engine='pyarrow', dtype=CENSUS_DTYPES)
+            write_census_parquet(df)
+            
+        # Indexed by zip so the upload join is a plain lookup, with the
+        # low population filter applied once here rather than per upload.
+        # One row per zip is required for the many-to-one join.
+        all_zips = df.set_index('zip_code')
+        if not all_zips.index.is_unique:
+            raise ValueError(f"{CENSUS_CSV} has duplicate zip codes")
+        return {
+            "all": all_zips,
+            "hi_pop": all_zips[all_zips['population'] >= 100],
+        }
     except FileNotFoundError:
         return None
 
-census_df = load_census_data()
+census_lookup = load_census_data()
 
-if census_df is None:
+if census_lookup is None:
     st.error("CRITICAL ERROR: 'census_reference.csv' not found. Please ensure the reference file is in the repository.")
     st.stop()
 
 # --- HELPER: ROBUST ZIP FINDER ---
+# Extensive list of potential headers for Zip Code
+ZIP_CANDIDATES = (
+    'zip', 'zipcode', 'zip code', 'zip_code', 
+    'postal', 'postal code', 'postal_code', 'postcode', 'post_code',
+    'billing zip', 'billing_zip', 'billing postal', 'billing_postal_code',
+    'shipping zip', 'shipping_zip', 'shipping postal', 'shipping_postal_code'
+)
+ZIP_CANDIDATE_SET = frozenset(ZIP_CANDIDATES)
+
 def find_zip_column(df):
-    # Extensive list of potential headers for Zip Code
-    candidates = [
-        'zip', 'zipcode', 'zip code', 'zip_code', 
-        'postal', 'postal code', 'postal_code', 'postcode', 'post_code',
-        'billing zip', 'billing_zip', 'billing postal', 'billing_postal_code',
-        'shipping zip', 'shipping_zip', 'shipping postal', 'shipping_postal_code'
-    ]
-    
     # 1. Exact match (case insensitive)
     for col in df.columns:
-        if str(col).lower().strip() in candidates:
+        if str(col).lower().strip() in ZIP_CANDIDATE_SET:
             return col
             
     # 2. Fuzzy match (contains keyword)
-    for col in df.columns:
-        col_lower = str(col).lower()
-        for c in candidates:
-            if c in col_lower:
-                return col
-    return None
+    return next((col for col in df.columns if any(c in str(col).lower() for c in ZIP_CANDIDATES)), None)
 
 def clean_zip_codes(series):
-    s = series.astype(str).str.split('.').str[0]  
-    s = s.str.split('-').str[0]                   
-    s = s.str.strip().str.zfill(5)                
-    return s
+    # One anchored pass handles floats (94103.0), ZIP+4 (94103-1234) and stray
+    # whitespace. Anything longer than 5 digits (e.g. Indian PINs like 560011)
+    # is rejected rather than truncated, so international codes never match.
+    # The result is an integer key, which makes leading zeros irrelevant and
+    # lets the join probe an int hashtable.
+    return series.astype('string').str.extract(r'^\s*(\d{1,5})(?:\.0*|-\d*)?\s*$', expand=False).astype('UInt32')
+
+# --- UPLOAD PROCESSING (Cached) ---
+def arrow_only_type(dtype):
+    # Types the C engine never infers: non-UTF-8 text comes back as binary
+    # (the C engine raises a decode error) and HH:MM:SS as time (kept as text)
+    if not isinstance(dtype, pd.ArrowDtype): return False
+    t = dtype.pyarrow_dtype
+    return pa.types.is_binary(t) or pa.types.is_large_binary(t) or pa.types.is_time(t)
+
+def parse_csv(raw_bytes):
+    df = pd.read_csv(io.BytesIO(raw_bytes), engine='pyarrow', dtype_backend='pyarrow')
+    # The pyarrow engine keeps duplicate headers as-is and guesses some types
+    # the C engine doesn't; re-read those files with the C engine so the
+    # result matches it (phone, phone.1, text times, clear encoding errors)
+    if df.columns.has_duplicates or any(arrow_only_type(d) for d in df.dtypes):
+        df = pd.read_csv(io.BytesIO(raw_bytes), dtype_backend='pyarrow')
+    return df
+
+
+# Keyed on the uploaded bytes, so re-runs (e.g. toggling the sidebar filter)
+# skip re-parsing. max_entries bounds how many customer files stay in memory.
+@st.cache_data(show_spinner=False, max_entries=10)
+def parse_upload(raw_bytes, name):
+    if name.endswith('.csv'): return parse_csv(raw_bytes)
+    # calamine is a Rust streaming reader, much lighter than openpyxl's full worksheet load
+    return pd.read_excel(io.BytesIO(raw_bytes), engine='calamine')
+
+@st.cache_data(show_spinner=False, max_entries=10)
+def enrich_upload(raw_bytes, name, exclude_low_pop):
+    df = parse_upload(raw_bytes, name)
+    
+    # Find Zip Column (Robust Search)
+    zip_col = find_zip_column(df)
+    if not zip_col:
+        return None, None
+        
+    # Clean User Zips
+    join_zip = clean_zip_codes(df[zip_col])
+    
+    # Prepare Census Data
+    ref_df = census_lookup["hi_pop"] if exclude_low_pop else census_lookup["all"]
+        
+    # Perform the Join: one hash probe per zip, then a positional take of
+    # all census columns (unmatched rows are blanked afterwards)
+    idx = ref_df.index.get_indexer(join_zip)
+    matched = idx >= 0
+    enriched = ref_df.take(np.where(matched, idx, 0)).rename(columns=CENSUS_COLUMNS)
+    enriched.index = df.index
+    enriched = enriched.where(pd.Series(matched, index=df.index), axis=0)
+    
+    return pd.concat([df, enriched], axis=1), zip_col
+
+# Smart Column Reordering: Zip first, then metrics, then the rest
+def report_column_order(df, zip_col):
+    metric_cols = list(CENSUS_COLUMNS.values())
+    cols = [c for c in df.columns if c not in metric_cols and c != zip_col]
+    return [zip_col] + metric_cols + cols
 
 # --- EXCEL GENERATOR ---
+# Side panel text written to column J of the report: (row, title, text, link)
+REPORT_SIDE_BLOCKS = [
+    (4, "1. What this report shows", 
+     "We have matched your customer Zip Codes against the US Census Bureau database. You now have the Median Household Income, Median Age, and Total Population for the area where each customer lives.", None),
+    
+    (8, "2. Actionable strategies", 
+     "**• Build 'High earner' segments:** Filter this list for Income > $100k. Upload this segment to Meta/Google as a Custom Audience for your premium products.\n"
+     "**• Adjust creative strategy:** If your Median Age is higher than expected (e.g., 45+), test creative that resonates with an older demographic rather than Gen Z trends.\n"
+     "**• Geographic targeting:** Identify which specific Zip codes yield your highest value customers and bid more aggressively in those locations.", None),
+    
+    (12, "3. Important caveats", 
+     "• Geographic Enrichment: This describes the neighborhood profile, not individual credit data.\n"
+     "• Match Rates: Zip codes for PO Boxes or large commercial buildings may not have Census data (showing as N/A).", None),
+    
+    (16, "4. Need deeper analysis?", 
+     "This is just the start. We can help you calculate Customer Lifetime Value (LTV) by demographic segment to see exactly how much 'High Income' customers are actually worth to your brand.", None),
+    
+    (20, "5. More free tools & resources", 
+     "Get our automated GA4 audit, Data Strategy Guide, and Looker Studio templates.", 
+     "https://go.systematikdata.com/DtiYck"),
+
+    (24, "Powered by Systematik", 
+     "Full-stack data agency for ecommerce brands ($5M-$100M).", None),
+    
+    (28, "Visit our website", "systematikdata.com", "https://go.systematikdata.com/ZA4N87"),
+]
+
+def tz_aware_type(dtype):
+    if isinstance(dtype, pd.ArrowDtype):
+        t = dtype.pyarrow_dtype
+        return pa.types.is_timestamp(t) and t.tz is not None
+    return isinstance(dtype, pd.DatetimeTZDtype)
+
+def excel_rows(df):
+    # Excel has no timezones (openpyxl raises, pyexcelerate drops the offset),
+    # so tz-aware timestamps are written as naive UTC
+    tz_cols = [col for col, dtype in df.dtypes.items() if tz_aware_type(dtype)]
+    if tz_cols:
+        df = df.copy()
+        for col in tz_cols: df[col] = df[col].dt.tz_convert(None)
+    
+    # Both writers choke on NaN (#NUM! / 'nan'), so blank out missing values first
+    return df.astype(object).where(df.notna(), None).values.tolist()
+
+def time_kind(series):
+    # 'time' for time-of-day columns, 'duration' for timedeltas, None otherwise
+    dtype = series.dtype
+    if isinstance(dtype, pd.ArrowDtype):
+        t = dtype.pyarrow_dtype
+        if pa.types.is_time(t): return 'time'
+        return 'duration' if pa.types.is_duration(t) else None
+    if pd.api.types.is_timedelta64_dtype(dtype): return 'duration'
+    # calamine returns time-only cells as an object column of datetime.time
+    if dtype == object and pd.api.types.infer_dtype(series) == 'time': return 'time'
+    return None
+
 def convert_to_excel(df, report_type):
+    try:
+        from pyexcelerate import Workbook, Style, Font, Alignment, Color, Format
+    except ImportError:
+        return convert_to_excel_openpyxl(df, report_type)
+
     output = io.BytesIO()
     
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, startrow=0, sheet_name='Report')
-        
-        workbook = writer.book
-        worksheet = writer.sheets['Report']
-        
-        from openpyxl.styles import Font, Alignment
-        
-        bold_font = Font(bold=True, name='Arial', size=11)
-        regular_font = Font(name='Arial', size=10)
-        purple_link_font = Font(name='Arial', size=10, color="7030A0", underline="single")
-        header_font = Font(bold=True, name='Arial', size=14)
-        text_align = Alignment(wrap_text=True, vertical='top')
-        
-        def write_side_block(row, title, text, link=None):
-            cell_title = worksheet[f'J{row}']
-            cell_title.value = title
-            cell_title.font = bold_font
-            
-            cell_text = worksheet[f'J{row+1}']
-            cell_text.value = text
-            cell_text.font = regular_font if not link else purple_link_font
-            cell_text.alignment = text_align
-            if link: cell_text.hyperlink = link
-
-        worksheet['J1'] = "Systematik data — Customer enrichment report"
-        worksheet['J1'].font = header_font
+    # pyexcelerate writes timedeltas as text ('0 days 01:30:00'), so durations
+    # are converted to the fraction-of-a-day numbers Excel stores them as
+    time_kinds = [time_kind(df.iloc[:, i]) for i in range(df.shape[1])]
+    if 'duration' in time_kinds:
+        df = df.copy()
+        for i, kind in enumerate(time_kinds):
+            if kind == 'duration': df.isetitem(i, df.iloc[:, i] / pd.Timedelta(days=1))
+    
+    workbook = Workbook()
+    worksheet = workbook.new_sheet('Report', data=[list(df.columns)] + excel_rows(df))
+    worksheet.set_row_style(1, Style(font=Font(bold=True)))
+    
+    bold_font = Font(bold=True, family='Arial', size=11)
+    regular_font = Font(family='Arial', size=10)
+    purple_link_font = Font(family='Arial', size=10, color=Color(0x70, 0x30, 0xA0), underline=True)
+    header_font = Font(bold=True, family='Arial', size=14)
+    text_align = Alignment(wrap_text=True, vertical='top')
+    
+    # One Style object per look, shared by every cell/column that uses it
+    title_style = Style(font=bold_font)
+    text_style = Style(font=regular_font, alignment=text_align)
+    link_style = Style(font=purple_link_font, alignment=text_align)
+    
+    def write_side_block(row, title, text, link=None):
+        worksheet.set_cell_value(row, 10, title)
+        worksheet.set_cell_style(row, 10, title_style)
         
-        worksheet['J2'] = f"Report: {report_type} | Date: {pd.Timestamp.now().strftime('%Y-%m-%d')}"
-        worksheet['J2'].font = regular_font
+        if link:
+            worksheet.set_cell_value(row + 1, 10, f'=HYPERLINK("{link}", "{text}")')
+            worksheet.set_cell_style(row + 1, 10, link_style)
+        else:
+            worksheet.set_cell_value(row + 1, 10, text)
+            worksheet.set_cell_style(row + 1, 10, text_style)
 
-        write_side_block(4, "1. What this report shows", 
-                         "We have matched your customer Zip Codes against the US Census Bureau database. You now have the Median Household Income, Median Age, and Total Population for the area where each customer lives.")
-        
-        write_side_block(8, "2. Actionable strategies", 
-                         "**• Build 'High earner' segments:** Filter this list for Income > $100k. Upload this segment to Meta/Google as a Custom Audience for your premium products.\n"
-                         "**• Adjust creative strategy:** If your Median Age is higher than expected (e.g., 45+), test creative that resonates with an older demographic rather than Gen Z trends.\n"
-                         "**• Geographic targeting:** Identify which specific Zip codes yield your highest value customers and bid more aggressively in those locations.")
-        
-        write_side_block(12, "3. Important caveats", 
-                         "• Geographic Enrichment: This describes the neighborhood profile, not individual credit data.\n"
-                         "• Match Rates: Zip codes for PO Boxes or large commercial buildings may not have Census data (showing as N/A).")
-        
-        write_side_block(16, "4. Need deeper analysis?", 
-                         "This is just the start. We can help you calculate Customer Lifetime Value (LTV) by demographic segment to see exactly how much 'High Income' customers are actually worth to your brand.")
-        
-        write_side_block(20, "5. More free tools & resources", 
-                         "Get our automated GA4 audit, Data Strategy Guide, and Looker Studio templates.", 
-                         link="https://go.systematikdata.com/DtiYck")
+    worksheet.set_cell_value(1, 10, "Systematik data — Customer enrichment report")
+    worksheet.set_cell_style(1, 10, Style(font=header_font))
+    
+    worksheet.set_cell_value(2, 10, f"Report: {report_type} | Date: {pd.Timestamp.now().strftime('%Y-%m-%d')}")
+    worksheet.set_cell_style(2, 10, Style(font=regular_font))
 
-        write_side_block(24, "Powered by Systematik", 
-                         "Full-stack data agency for ecommerce brands ($5M-$100M).")
-        
-        write_side_block(28, "Visit our website", "systematikdata.com", link="https://go.systematikdata.com/ZA4N87")
+    for row, title, text, link in REPORT_SIDE_BLOCKS:
+        write_side_block(row, title, text, link)
 
-        worksheet.column_dimensions['J'].width = 70
-        for col in ['F', 'G', 'H', 'I']: worksheet.column_dimensions[col].width = 5
-        
-        # Auto-fit Data columns
-        for i, col in enumerate(df.columns):
-             col_letter = chr(65 + i) if i < 26 else 'A' 
-             worksheet.column_dimensions[col_letter].width = 18
+    worksheet.set_col_style(10, Style(size=70))
+    spacer_style = Style(size=5)
+    for col in [6, 7, 8, 9]: worksheet.set_col_style(col, spacer_style)
+    
+    # Auto-fit Data columns (numeric indexes, so columns past Z are sized correctly).
+    # pyexcelerate writes dates and times as bare serial numbers, so those columns
+    # also get number formats ([h] so durations past 24 hours don't wrap).
+    data_col_style = Style(size=18)
+    date_col_style = Style(size=18, format=Format('yyyy-mm-dd'))
+    datetime_col_style = Style(size=18, format=Format('yyyy-mm-dd hh:mm:ss'))
+    time_col_style = Style(size=18, format=Format('hh:mm:ss'))
+    duration_col_style = Style(size=18, format=Format('[h]:mm:ss'))
+    for col, (dtype, kind) in enumerate(zip(df.dtypes, time_kinds), start=1):
+        if kind == 'time':
+            worksheet.set_col_style(col, time_col_style)
+        elif kind == 'duration':
+            worksheet.set_col_style(col, duration_col_style)
+        elif not pd.api.types.is_datetime64_any_dtype(dtype):
+            worksheet.set_col_style(col, data_col_style)
+        elif isinstance(dtype, pd.ArrowDtype) and str(dtype).startswith('date'):
+            worksheet.set_col_style(col, date_col_style)
+        else:
+            worksheet.set_col_style(col, datetime_col_style)
+
+    workbook.save(output)
+    return output.getvalue()
+
+# Called lazily by the download button, and cached per file + filter so the
+# workbook is only built once and only if the user actually downloads it
+@st.cache_data(show_spinner=False, max_entries=10)
+def build_enriched_excel(raw_bytes, name, exclude_low_pop):
+    final_df, zip_col = enrich_upload(raw_bytes, name, exclude_low_pop)
+    return convert_to_excel(final_df[report_column_order(final_df, zip_col)], "Customer demographics")
+
+# on_click for the download button. Errors in the deferred build only reach the
+# server log, so the same (cached, locked per key) build is checked here at the
+# start of the rerun the click triggers, and any failure is kept for display.
+def check_enriched_excel(file_id, raw_bytes, name, exclude_low_pop):
+    try:
+        build_enriched_excel(raw_bytes, name, exclude_low_pop)
+        st.session_state.pop('excel_error', None)
+    except Exception as e:
+        st.session_state['excel_error'] = ((file_id, exclude_low_pop), str(e))
+
+# Fallback when pyexcelerate is not installed: openpyxl in write-only mode
+# streams rows to the zip instead of building a cell object per value.
+def convert_to_excel_openpyxl(df, report_type):
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Alignment
+    from openpyxl.utils import get_column_letter
+    from openpyxl.worksheet.dimensions import ColumnDimension
+    
+    output = io.BytesIO()
+    
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Report')
+    
+    bold_font = Font(bold=True, name='Arial', size=11)
+    regular_font = Font(name='Arial', size=10)
+    purple_link_font = Font(name='Arial', size=10, color="7030A0", underline="single")
+    header_font = Font(bold=True, name='Arial', size=14)
+    text_align = Alignment(wrap_text=True, vertical='top')
+    
+    def side_cell(value, font, alignment=None, link=None):
+        cell = WriteOnlyCell(worksheet, value=value)
+        cell.font = font
+        if alignment: cell.alignment = alignment
+        if link: cell.hyperlink = link
+        return cell
+
+    # Rows are written strictly in order, so collect the column J cells up front
+    side_cells = {
+        1: side_cell("Systematik data — Customer enrichment report", header_font),
+        2: side_cell(f"Report: {report_type} | Date: {pd.Timestamp.now().strftime('%Y-%m-%d')}", regular_font),
+    }
+    for row, title, text, link in REPORT_SIDE_BLOCKS:
+        side_cells[row] = side_cell(title, bold_font)
+        side_cells[row + 1] = side_cell(text, purple_link_font if link else regular_font, text_align, link)
+
+    # Column widths must be set before the first row is streamed. Built as a
+    # plain dict and inserted in one update; data columns win over the spacers.
+    widths = {'J': 70, 'F': 5, 'G': 5, 'H': 5, 'I': 5}
+    
+    # Auto-fit Data columns
+    widths.update((get_column_letter(i + 1), 18) for i in range(len(df.columns)))
+    worksheet.column_dimensions.update(
+        (letter, ColumnDimension(worksheet, index=letter, width=width)) for letter, width in widths.items()
+    )
 
+    header = [WriteOnlyCell(worksheet, value=col) for col in df.columns]
+    for cell in header: cell.font = Font(bold=True)
+    
+    rows = [header] + excel_rows(df)
+    rows += [[] for _ in range(max(side_cells) - len(rows))]
+    
+    for row_num, values in enumerate(rows, start=1):
+        if row_num in side_cells:
+            values = list(values) + [None] * (10 - len(values))
+            values[9] = side_cells[row_num]
+        worksheet.append(values)
+
+    workbook.save(output)
     return output.getvalue()
 
 # --- SIDEBAR ---
@@ -240,45 +491,25 @@ if uploaded_file:
     
     try:
         with st.spinner("Matching with Census database..."):
-            # 1. Load User Data
-            if uploaded_file.name.endswith('.csv'): df = pd.read_csv(uploaded_file)
-            else: df = pd.read_excel(uploaded_file)
-            
-            # 2. Find Zip Column (Robust Search)
-            zip_col = find_zip_column(df)
+            # 1-6. Load, clean and join with Census (cached per file + filter)
+            final_df, zip_col = enrich_upload(uploaded_file.getvalue(), uploaded_file.name, exclude_low_pop)
             
             if not zip_col:
                 st.error(APP_CONFIG["error_msg"])
                 st.stop()
-                
-            # 3. Clean User Zips
-            df['__join_zip'] = clean_zip_codes(df[zip_col])
             
-            # 4. Prepare Census Data
-            ref_df = census_df.copy()
-            if exclude_low_pop:
-                ref_df = ref_df[ref_df['population'] >= 100]
-                
-            # 5. Perform the Join
-            merged = pd.merge(df, ref_df, left_on='__join_zip', right_on='zip_code', how='left')
+            # 7. Calculate Metrics (each column is pulled out and scanned once)
+            income = final_df['Estimated household income'].to_numpy(dtype='float64', na_value=np.nan)
+            age = final_df['Median age'].to_numpy(dtype='float64', na_value=np.nan)
             
-            # 6. Cleanup & Renaming
-            merged = merged.rename(columns={
-                'median_income': 'Estimated household income',
-                'median_age': 'Median age',
-                'population': 'Zip population'
-            })
-            
-            cols_to_drop = ['__join_zip', 'zip_code']
-            final_df = merged.drop(columns=[c for c in cols_to_drop if c in merged.columns])
-            
-            # 7. Calculate Metrics
             total_rows = len(final_df)
-            matched_rows = final_df['Estimated household income'].notna().sum()
+            has_income = ~np.isnan(income)
+            matched_rows = has_income.sum()
             match_rate = (matched_rows / total_rows) if total_rows > 0 else 0
             
-            avg_income = final_df['Estimated household income'].mean()
-            avg_age = final_df['Median age'].mean()
+            avg_income = income[has_income].mean() if matched_rows else np.nan
+            known_age = age[~np.isnan(age)]
+            avg_age = known_age.mean() if known_age.size else np.nan
 
     except Exception as e:
         st.error(f"Something went wrong during processing: {e}")
@@ -301,52 +532,36 @@ if uploaded_file:
         st.divider()
         st.subheader("Enriched data preview")
         
-        # 9. Smart Column Reordering
-        metric_cols = ['Estimated household income', 'Median age', 'Zip population']
-        # Ensure Zip is first, then metrics, then rest
-        cols = list(final_df.columns)
-        for c in metric_cols + [zip_col]:
-            if c in cols: cols.remove(c)
-            
-        display_order = [zip_col] + metric_cols + cols
-        final_df = final_df[display_order]
-        
-        # Table Header Styling
-        header_styles = [
-            {'selector': 'th', 'props': [
-                ('background-color', '#1A1A1A'), 
-                ('color', '#F3F3F3'), 
-                ('font-weight', 'bold')
-            ]}
-        ]
+        # 9. Smart Column Reordering (preview slice only, not final_df itself)
+        display_order = report_column_order(final_df, zip_col)
         
+        # Number formats are applied client-side; header styling lives in style.css
         st.dataframe(
-            final_df.head(100).style.set_table_styles(header_styles).format({
-                'Estimated household income': '${:,.0f}', 
-                'Median age': '{:.1f}', 
-                'Zip population': '{:,.0f}'
-            }), 
-            use_container_width=True, 
+            final_df.head(100)[display_order],
+            column_config={
+                'Estimated household income': st.column_config.NumberColumn(format='$%,d'), 
+                'Median age': st.column_config.NumberColumn(format='%.1f'), 
+                'Zip population': st.column_config.NumberColumn(format='%,d')
+            }, 
+            width='stretch', 
             hide_index=True
         )
         
-        # 3. EXCEL GENERATION PHASE (New Spinner)
-        # This tells the user: "We are done calculating, now we are just building the file."
-        excel_data = None
-        with st.spinner("Generating Excel file... (This may take a moment for large files)"):
-            try:
-                excel_data = convert_to_excel(final_df, "Customer demographics")
-            except Exception as e:
-                st.error(f"Error generating Excel file: {e}")
+        # 3. EXCEL GENERATION PHASE
+        # Deferred: the workbook is only built when the user clicks Download.
+        excel_args = (uploaded_file.getvalue(), uploaded_file.name, exclude_low_pop)
+        st.download_button(
+            "Download Enriched Excel", 
+            partial(build_enriched_excel, *excel_args), 
+            "customer_demographics_enriched.xlsx", 
+            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click=check_enriched_excel,
+            args=(uploaded_file.file_id, *excel_args)
+        )
         
-        if excel_data:
-            st.download_button(
-                "Download Enriched Excel", 
-                excel_data, 
-                "customer_demographics_enriched.xlsx", 
-                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-
-            )
+        excel_error = st.session_state.get('excel_error')
+        if excel_error and excel_error[0] == (uploaded_file.file_id, exclude_low_pop):
+            st.error(f"Error generating Excel file: {excel_error[1]}")
 
 
 